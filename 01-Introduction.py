@@ -4,9 +4,9 @@
 # COMMAND ----------
 
 # MAGIC %md
-# MAGIC # Biomedical Question Answering over Custom Datasets with 🦜️🔗 LangChain and Open Source LLMs on Spark NLP
+# MAGIC # Biomedical Question Answering over Custom Datasets with 🦜️🔗 LangChain and Open Source LLMs
 # MAGIC
-# MAGIC Large Language Models produce some amazing results, chatting and answering questions with seeming intelligence. But how can you get LLMs to answer questions about _your_ specific datasets? Imagine answering questions based on your company's knowledge base, docs or Slack chats. The good news is that this is easy with open-source tooling and LLMs. This example shows how to apply [LangChain](https://python.langchain.com/en/latest/index.html), Spark NLP [`sent_bert_base_uncased`](https://sparknlp.org/2020/08/25/sent_bert_base_uncased.html), and this open source model that contains a deep bidirectional transformer trained on Wikipedia and the BookCorpus. The details are described in the paper [“BERT: Pre-training of Deep Bidirectional Transformers for Language Understanding”](https://sparknlp.org/2020/08/25/sent_bert_base_uncased.html). This example can make use of any text-generation LLM or even OpenAI with minor changes. In this case, the data set is a set of freely available published papers in PDF format about cystic fibrosis from PubMed, but could be any corpus of text.
+# MAGIC Large Language Models produce some amazing results, chatting and answering questions with seeming intelligence. But how can you get LLMs to answer questions about _your_ specific datasets? Imagine answering questions based on your company's knowledge base, docs or Slack chats. The good news is that this is easy with open-source tooling and LLMs. This example shows how to apply [LangChain](https://python.langchain.com/en/latest/index.html), the [`all-MiniLM-L6-v2`](https://huggingface.co/sentence-transformers/all-MiniLM-L6-v2) sentence transformer from Hugging Face, a small and fast open source model that maps text to a 384-dimensional embedding, and open source LLMs. This example can make use of any text-generation LLM or even OpenAI with minor changes. In this case, the data set is a set of freely available published papers in PDF format about cystic fibrosis from PubMed, but could be any corpus of text.
 
 # COMMAND ----------
 
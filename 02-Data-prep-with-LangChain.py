@@ -29,29 +29,33 @@
 # COMMAND ----------
 
 # MAGIC %md
-# MAGIC Creating a dropdown widget for model selection, as well as defining the file paths where our PDFs are stored, where we want to cache the Spark NLP model downloads, and where we want to persist our vectorstore.
+# MAGIC Creating a dropdown widget for model selection, as well as defining the file paths where our PDFs are stored, where we want to cache computed embeddings, and where we want to persist our vectorstore.
 
 # COMMAND ----------
 
-# where you want the PDFs to be saved in your environment
-dbutils.widgets.text("PDF_Path", "/dbfs/tmp/langchain_hls/pdfs")
-
-# which embeddings model from Spark NLP
-dbutils.widgets.text("Embeddings_Model", "en.embed_sentence.bert_base_uncased")
+# which embeddings model from Hugging Face (any sentence-transformers model works)
+dbutils.widgets.text("Embeddings_Model", "sentence-transformers/all-MiniLM-L6-v2")
 
 # where you want the vectorstore to be persisted across sessions, so that you don't have to regenerate
 dbutils.widgets.text("Vectorstore_Persist_Path", "/dbfs/tmp/langchain_hls/db")
 
+# where you want computed embeddings to be cached across runs, so that unchanged chunks don't have to be re-embedded
+dbutils.widgets.text("Embeddings_Cache_Path", "/dbfs/tmp/langchain_hls/emb_cache.sqlite")
+
 # publicly accessible bucket with PDFs for this demo
 dbutils.widgets.text("Source_Documents", "s3a://db-gtm-industry-solutions/data/hls/llm_qa/")
 
+# whether to read the source bucket without credentials; set to false to use the cluster's credentials for a private bucket
+dbutils.widgets.dropdown("Unsigned_S3_Access", "true", ["true", "false"])
+
 # COMMAND ----------
 
 #get widget values
-pdf_path = dbutils.widgets.get("PDF_Path")
 source_pdfs = dbutils.widgets.get("Source_Documents")
+unsigned_s3_access = dbutils.widgets.get("Unsigned_S3_Access") == "true"
 db_persist_path = dbutils.widgets.get("Vectorstore_Persist_Path")
 embeddings_model = dbutils.widgets.get("Embeddings_Model")
+embeddings_cache_path = dbutils.widgets.get("Embeddings_Cache_Path")
 
 # COMMAND ----------
 
@@ -69,27 +73,32 @@ import os
 # MAGIC - Grab the set of PDFs (ex: Arxiv papers allow curl, PubMed does not)
 # MAGIC - We have are providing a set of PDFs from PubMedCentral relating to Cystic Fibrosis (all from [PubMedCentral Open Access](https://www.ncbi.nlm.nih.gov/pmc/tools/openftlist/), all with the CC BY license), but any topic area would work
 # MAGIC - If you already have a repository of PDFs then you can skip this step, just organize them all in an accessible DBFS location
+# MAGIC - Rather than copying the PDFs to DBFS first, we stream them straight from S3 into the PDF parser, so each PDF is only read once
 
 # COMMAND ----------
 
-import os
-import shutil
+import functools
+from urllib.parse import urlparse
+
+import boto3
+from botocore import UNSIGNED
+from botocore.config import Config
 
-# in case you rerun this notebook, this deletes the directory and recreates it to prevent file duplication
-if os.path.exists(pdf_path):
-  shutil.rmtree(pdf_path, ignore_errors=True)
-os.makedirs(pdf_path)
+source_url = urlparse(source_pdfs)
+source_bucket, source_prefix = source_url.netloc, source_url.path.lstrip("/")
 
-# slightly modifying the file path from above to work with the dbutils.fs syntax
-modified_pdf_path = "dbfs:/" + pdf_path.lstrip("/dbfs")
-dbutils.fs.cp(source_pdfs, modified_pdf_path, True)
+# the demo bucket is public, so its requests don't need to be signed; any other bucket is read with the cluster's default credentials
+s3_config = Config(signature_version=UNSIGNED) if unsigned_s3_access else Config()
+
+pages = boto3.client("s3", config=s3_config).get_paginator("list_objects_v2").paginate(Bucket=source_bucket, Prefix=source_prefix)
+pdf_keys = sorted(obj["Key"] for page in pages for obj in page.get("Contents", []) if obj["Key"].endswith(".pdf"))
 
 # COMMAND ----------
 
 # MAGIC %md
-# MAGIC All of the PDFs should now be accessible in the `pdf_path` now; you can run the below command to check if you want.
+# MAGIC All of the PDFs in `source_pdfs` are now listed in `pdf_keys`; you can run the below command to check if you want.
 # MAGIC
-# MAGIC `!ls {pdf_path}`
+# MAGIC `pdf_keys`
 
 # COMMAND ----------
 
@@ -100,7 +109,7 @@ dbutils.fs.cp(source_pdfs, modified_pdf_path, True)
 # MAGIC These documents are embedded, so that later queries can be embedded too, and matched to relevant text chunks by embedding.
 # MAGIC
 # MAGIC - Use `langchain` to reading directly from PDFs, although LangChain also supports txt, HTML, Word docs, GDrive, PDFs, etc.
-# MAGIC - Create a simple in-memory Chroma vector DB for storage
+# MAGIC - Create a simple in-memory FAISS vector DB for storage; for a corpus this size a flat index that scans every vector is fast enough, and avoids building a graph index. Vectors are stored as 8-bit scalar-quantized values, so similarity scores are close approximations rather than exact, which rarely changes which chunks are retrieved
 # MAGIC - Instantiate an embedding function from `sentence-transformers`
 # MAGIC - Populate the database and save it
 
@@ -117,17 +126,30 @@ dbutils.fs.cp(source_pdfs, modified_pdf_path, True)
 
 # MAGIC %md
 # MAGIC Create the document database:
-# MAGIC - Here we are using the `PyPDFDirectoryLoader` loader from LangChain ([docs page](https://python.langchain.com/en/latest/modules/indexes/document_loaders/examples/pdf.html#using-pypdf)) to form `documents`; `langchain` can also form doc collections directly from PDFs, GDrive files, etc.
+# MAGIC - Here we are extracting the text of each PDF page with [PyMuPDF](https://pymupdf.readthedocs.io/) into LangChain `Document`s, one per page with the same `source` and `page` metadata that LangChain's `PyPDFDirectoryLoader` would give us; `langchain` can also form doc collections directly from PDFs, GDrive files, etc.
+# MAGIC - Each PDF is read from S3 into memory and parsed from there, without being written to disk
+# MAGIC - The PDFs are independent of each other, so they are loaded in parallel, one process per core
 
 # COMMAND ----------
 
+from concurrent.futures import ProcessPoolExecutor
+
+import fitz
 from langchain.docstore.document import Document
-from langchain.document_loaders import PyPDFDirectoryLoader
 
-loader_path = f"{pdf_path}/"
+# boto3 clients can't be shared across processes, so each worker process creates its own on first use
+@functools.lru_cache(maxsize=None)
+def get_s3_client():
+  return boto3.client("s3", config=s3_config)
+
+def load_pdf(key):
+  source = f"s3://{source_bucket}/{key}"
+  body = get_s3_client().get_object(Bucket=source_bucket, Key=key)["Body"].read()
+  with fitz.open(stream=body, filetype="pdf") as pdf:
+    return [Document(page_content=page.get_text(), metadata={"source": source, "page": i}) for i, page in enumerate(pdf)]
 
-pdf_loader = PyPDFDirectoryLoader(loader_path)
-docs = pdf_loader.load()
+with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+  docs = [doc for pages in executor.map(load_pdf, pdf_keys) for doc in pages]
 len(docs)
 
 # COMMAND ----------
@@ -136,78 +158,161 @@ len(docs)
 # MAGIC Here we are using a text splitter from LangChain to split our PDFs into manageable chunks. This is for a few reasons, primarily:
 # MAGIC - LLMs (currently) have a limited context length. MPT-7b-Instruct by default can only accept 2048 tokens (roughly words) in the prompt, although it can accept 4096 with a small settings change. This is rapidly changing, though, so keep an eye on it.
 # MAGIC - When we create embeddings for these documents, an NLP model (sentence transformer) creates a numerical representation (a high-dimensional vector) of that chunk of text that captures the semantic meaning of what is being embedded. If we were to embed large documents, the NLP model would need to capture the meaning of the entire document in one vector; by splitting the document, we can capture the meaning of chunks throughout that document and retrieve only what is most relevant.
-# MAGIC - In this case, the embeddings model we use can except a very limited number of tokens. The default one we have selected in this notebook, [bert_base_uncased](https://sparknlp.org/2020/08/25/bert_base_uncased.html)
-# MAGIC - More info on embeddings: [Spark NLP: Embeddings](https://nlp.johnsnowlabs.com/models?task=Embeddings)
+# MAGIC - In this case, the embeddings model we use can except a very limited number of tokens. The default one we have selected in this notebook, [all-MiniLM-L6-v2](https://huggingface.co/sentence-transformers/all-MiniLM-L6-v2), was trained on inputs of up to 128 tokens and truncates its input at 256 tokens, so we count chunk lengths with the model's own tokenizer to keep every chunk within 128 tokens, while keeping the original text of each chunk; it produces 384-dimensional embeddings at roughly twice the speed of a BERT-base model, with only a small loss in retrieval quality
+# MAGIC - More info on embeddings: [Sentence Transformers: Pretrained Models](https://www.sbert.net/docs/pretrained_models.html)
 
 # COMMAND ----------
 
 # For PDFs we need to split them for embedding:
-from johnsnowlabs import nlp
+import itertools
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from transformers import AutoTokenizer
 
-def split_hay_doc(pipe,doc):
-  from  langchain.schema.document import Document
-  return [Document(page_content=split, metadata = doc.metadata) for split in pipe.annotate(doc.page_content)['splits'] ]
-
-def split_hay_docs(pipe, docs):
-    return [split for doc in docs for split in split_hay_doc(pipe, doc)]
+# chunks are produced lazily, so we can peek at a few without splitting every document
+def iter_splits(splitter, docs):
+  for doc in docs:
+    for split in splitter.split_text(doc.page_content):
+      yield split, doc.metadata
 
+# COMMAND ----------
+# this is splitting into chunks based on a fixed number of tokens, counted with the embeddings model's own tokenizer
+# the tokenizer is only used to measure chunks, so the chunk text itself keeps its original casing, newlines and characters
+# the embeddings model we use below works best with up to 128 tokens, so we fill our chunks up to that max size (126 tokens plus the 2 special tokens the model adds)
+tokenizer = AutoTokenizer.from_pretrained(embeddings_model)
+text_splitter = RecursiveCharacterTextSplitter(length_function=lambda text: len(tokenizer.encode(text, add_special_tokens=False)), chunk_size=126, chunk_overlap=16)
 
-class JslCharSplitter():
-  def __init__(self,
-               chunk_overlap=2,
-               chunk_size=20,
-               explode_splits=True,
-               keep_seperators=True,
-               patterns_are_regex=False,
-               split_patterns=['\n\n', '\n', ' ', ''],
-               trim_whitespace=True):
+# COMMAND ----------
 
-    spark = nlp.start()
+# peek at the first few chunks
+display(list(itertools.islice(iter_splits(text_splitter, docs), 5)))
 
-    documentAssembler = nlp.DocumentAssembler()\
-        .setInputCol("text")\
-        .setOutputCol("document")
+# COMMAND ----------
 
-    textSplitter = nlp.DocumentCharacterTextSplitter() \
-        .setInputCols(["document"]) \
-        .setOutputCol("splits") \
-        .setChunkSize(chunk_size) \
-        .setChunkOverlap(chunk_overlap) \
-        .setExplodeSplits(explode_splits)\
-        .setPatternsAreRegex(patterns_are_regex)\
-        .setSplitPatterns(split_patterns)\
-        .setTrimWhitespace(trim_whitespace)
-        # .setKeepSeperators(keep_seperators)\
+# MAGIC %md
+# MAGIC Embed the chunks and store them in the FAISS DB:
+# MAGIC - Computing embeddings is by far the most expensive step, so rather than running it on the driver we wrap the embeddings model in a Pandas UDF and compute the embeddings in parallel across the cluster
+# MAGIC - The chunks are split into roughly one partition per worker; each Spark task loads the embeddings model once and then embeds all the Arrow batches of its partition (at most 256 chunks each) with it, `batch_size` chunks per forward pass
+# MAGIC - Embeddings are cached in a SQLite file on DBFS, keyed by a hash of the embeddings model and the chunk text, so rerunning this notebook only embeds chunks that have not been seen before
+# MAGIC - Chunks that occur more than once in the corpus (headers, footers, copyright notices, ...) are embedded only once and their embedding is reused for every occurrence
+# MAGIC - All the chunks are embedded in a single Spark job, so length ordering and deduplication apply across the whole corpus. All chunk texts, metadata and embeddings are kept in memory until the index is built; adding everything to the index in one go (which also lets the quantizer learn from every vector) takes priority over holding only one batch in memory
+# MAGIC - The precomputed embeddings are then added to a flat inner-product index in a single bulk insert, together with the chunk texts and their metadata. Vectors are L2-normalized, so the inner product is the cosine similarity
+# MAGIC - The index stores each vector component as an 8-bit integer (`IndexScalarQuantizer` with `QT_8bit`) rather than a 32-bit float, which cuts the size of the index, and the bytes read per search, by 4x
 
-    self.pipe =  nlp.LightPipeline(nlp.PipelineModel(
-        stages=[
-        documentAssembler,
-        textSplitter
-        ]))
+# COMMAND ----------
 
-  def split_documents(self,docs):
-    return split_hay_docs(self.pipe, docs)
+from typing import Iterator
+
+import pandas as pd
+from pyspark.sql.functions import pandas_udf
+from pyspark.sql.types import ArrayType, FloatType
+
+spark.conf.set("spark.sql.execution.arrow.maxRecordsPerBatch", 256)
+
+# one partition per worker (or a single one on a single-node cluster), so each worker loads the model for one task only
+embed_partitions = max(1, int(spark.conf.get("spark.databricks.clusterUsageTags.clusterWorkers", "1")))
+
+def load_embedder(model_name):
+  import torch
+  from langchain.embeddings import HuggingFaceEmbeddings
+  # the model encodes `batch_size` chunks per forward pass and returns unit-length embeddings
+  embeddings = HuggingFaceEmbeddings(model_name=model_name, model_kwargs={"device": "cuda" if torch.cuda.is_available() else "cpu"}, encode_kwargs={"batch_size": 128, "normalize_embeddings": True})
+  # on GPU, run the forward pass in half precision to use the tensor cores and halve activation memory
+  if torch.cuda.is_available():
+    embeddings.client.half()
+  return embeddings
+
+# embed a dummy query up front, so CUDA and allocator setup happen before the first real batch rather than inside it
+def warm_up(embeddings):
+  import torch
+  embeddings.embed_query("warmup")
+  if torch.cuda.is_available():
+    torch.cuda.synchronize()
+
+# an iterator UDF loads the model once per task and reuses it for every Arrow batch in the task's partition
+@pandas_udf(ArrayType(FloatType()))
+def embed_udf(batches: Iterator[pd.Series]) -> Iterator[pd.Series]:
+  embeddings = load_embedder(embeddings_model)
+  warm_up(embeddings)
+  for texts in batches:
+    yield pd.Series(embeddings.embed_documents(list(texts)))
+
+def embed_on_cluster(texts):
+  # sending the chunks in order of length keeps chunks of similar length in the same batch, so little of each forward pass is spent on padding
+  order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+  # coalesce merges neighbouring partitions without a shuffle, so the length order is kept
+  texts_df = spark.createDataFrame(pd.DataFrame({"id": order, "text": [texts[i] for i in order]})).coalesce(embed_partitions)
+  rows = texts_df.withColumn("embedding", embed_udf("text")).select("id", "embedding").collect()
+  return [row.embedding for row in sorted(rows, key=lambda row: row.id)]
 
 # COMMAND ----------
-# this is splitting into chunks based on a fixed number of tokens
-# the embeddings model we use below can take a maximum of 128 tokens (and truncates beyond that) so we keep our chunks at that max size
-jsl_splitter = JslCharSplitter(chunk_size=1000, chunk_overlap=0)
-texts = jsl_splitter.split_documents(docs)
+
+import hashlib
+import numpy as np
+
+def embedding_key(text):
+  return hashlib.sha256(f"{embeddings_model}|{text}".encode()).hexdigest()
+
+def embed_with_cache(emb_cache, texts, lookup_batch_size=500):
+  keys = [embedding_key(t) for t in texts]
+  # repeated chunks (headers, footers, license blocks, ...) share a key, so each distinct chunk is looked up and embedded only once
+  unique_texts = dict(zip(keys, texts))
+  unique_keys = list(unique_texts)
+
+  vecs = {}
+  for i in range(0, len(unique_keys), lookup_batch_size):
+    batch = unique_keys[i:i + lookup_batch_size]
+    query = f"SELECT hash, vec FROM emb WHERE hash IN ({','.join('?' * len(batch))})"
+    vecs.update((key, np.frombuffer(vec, dtype=np.float32)) for key, vec in emb_cache.execute(query, batch))
+
+  misses = [key for key in unique_keys if key not in vecs]
+  if misses:
+    new_vecs = [np.asarray(v, dtype=np.float32) for v in embed_on_cluster([unique_texts[key] for key in misses])]
+    emb_cache.executemany("INSERT OR REPLACE INTO emb VALUES (?, ?)", [(key, v.tobytes()) for key, v in zip(misses, new_vecs)])
+    emb_cache.commit()
+    vecs.update(zip(misses, new_vecs))
+
+  return np.stack([vecs[key] for key in keys])
 
 # COMMAND ----------
 
-display(documents)
+import shutil
+import sqlite3
+import tempfile
+
+chunks = list(iter_splits(text_splitter, docs))
+chunk_texts = [text for text, _ in chunks]
+chunk_metadatas = [metadata for _, metadata in chunks]
+
+# SQLite needs a local disk to write to, so we work on a fresh local copy of the cache and always copy it back to DBFS, even if embedding fails part way
+local_cache_path = os.path.join(tempfile.mkdtemp(), "emb_cache.sqlite")
+if os.path.exists(embeddings_cache_path):
+  shutil.copyfile(embeddings_cache_path, local_cache_path)
+
+emb_cache = sqlite3.connect(local_cache_path)
+try:
+  emb_cache.execute("CREATE TABLE IF NOT EXISTS emb (hash TEXT PRIMARY KEY, vec BLOB)")
+  # the embeddings model already returns unit-length vectors, so neither the index nor the queries need a separate normalization pass
+  vecs = embed_with_cache(emb_cache, chunk_texts)
+finally:
+  emb_cache.close()
+  os.makedirs(os.path.dirname(embeddings_cache_path), exist_ok=True)
+  shutil.copyfile(local_cache_path, embeddings_cache_path)
 
 # COMMAND ----------
 
-from langchain.vectorstores import Chroma
-from johnsnowlabs.llm import embedding_retrieval
+import faiss
+from langchain.docstore.in_memory import InMemoryDocstore
+from langchain.vectorstores import FAISS
+from langchain.vectorstores.utils import DistanceStrategy
 
-embeddings =  embedding_retrieval.JohnSnowLabsLangChainEmbedder(embeddings_model)
+# the quantizer learns the value range of each dimension from all the vectors it will store
+index = faiss.IndexScalarQuantizer(vecs.shape[1], faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT)
+index.train(vecs)
 
-sample_query = "What is cystic fibrosis?"
-db = Chroma.from_documents(collection_name="hls_docs", documents=documents, embedding=embeddings, persist_directory=db_persist_path)
-db.persist()
+embeddings = load_embedder(embeddings_model)
+db = FAISS(embedding_function=embeddings, index=index, docstore=InMemoryDocstore({}), index_to_docstore_id={}, distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT)
+db.add_embeddings(list(zip(chunk_texts, vecs)), metadatas=chunk_metadatas)
+db.save_local(db_persist_path)
 
 # COMMAND ----------
 
@@ -228,17 +333,19 @@ display(similar_docs)
 # MAGIC
 # MAGIC Now we can compose the database with a language model and prompting strategy to make a `langchain` chain that answers questions.
 # MAGIC
-# MAGIC - Load the Chroma DB
+# MAGIC - Load the FAISS DB
 # MAGIC - Instantiate an LLM, like Dolly here, but could be other models or even OpenAI models
 # MAGIC - Define how relevant texts are combined with a question into the LLM prompt
 
 # COMMAND ----------
 
 # Start here to load a previously-saved DB
-from langchain.vectorstores import Chroma
-from johnsnowlabs.llm import embedding_retrieval
+from langchain.vectorstores import FAISS
+from langchain.vectorstores.utils import DistanceStrategy
+from langchain.embeddings import HuggingFaceEmbeddings
+import torch
 
 db_persist_path = db_persist_path
-embeddings =  embedding_retrieval.JohnSnowLabsLangChainEmbedder(embeddings_model)
+embeddings = HuggingFaceEmbeddings(model_name=embeddings_model, model_kwargs={"device": "cuda" if torch.cuda.is_available() else "cpu"}, encode_kwargs={"batch_size": 128, "normalize_embeddings": True})
 
-db = Chroma(collection_name="hls_docs", embedding_function=embeddings, persist_directory=db_persist_path)
\ No newline at end of file
+db = FAISS.load_local(db_persist_path, embeddings, distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT)
\ No newline at end of file
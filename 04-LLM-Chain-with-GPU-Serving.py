@@ -37,8 +37,8 @@
 # which LLM do you want to use? Grab the name of the model you deployed in step 04 from Databricks Model Serving
 dbutils.widgets.text('model_name_from_model_serving',"llama-2-7b-chat")
 
-# embeddings model from Spark NLP 
-dbutils.widgets.text("Embeddings_Model", "en.embed_sentence.bert_base_uncased")
+# embeddings model from Hugging Face, the same one used to build the vectorstore in the previous notebook
+dbutils.widgets.text("Embeddings_Model", "sentence-transformers/all-MiniLM-L6-v2")
 
 # where was the vectorstore persisted in the previous notebook?
 dbutils.widgets.text("Vectorstore_Persist_Path", "/dbfs/tmp/langchain_hls/db")
@@ -56,23 +56,89 @@ embeddings_model = dbutils.widgets.get("Embeddings_Model")
 # MAGIC
 # MAGIC Now we can compose the database with a language model and prompting strategy to make a `langchain` chain that answers questions.
 # MAGIC
-# MAGIC - Load the Chroma DB and define our retriever. We define `k` here, which is how many chunks of text we want to retrieve from the vectorstore to feed into the LLM
+# MAGIC - Load the FAISS DB and define `k`, which is how many chunks of text we want to retrieve from the vectorstore to feed into the LLM
 # MAGIC - Instantiate an LLM, loading from Databricks Model serving here, but could be other models or even OpenAI models
 # MAGIC - Define how relevant texts are combined with a question into the LLM prompt
 
 # COMMAND ----------
 
 # Start here to load a previously-saved DB
-from langchain.vectorstores import Chroma
-from johnsnowlabs.llm import embedding_retrieval
+from langchain.vectorstores import FAISS
+from langchain.vectorstores.utils import DistanceStrategy
+from langchain.embeddings import HuggingFaceEmbeddings
+import torch
 
 db_persist_path = db_persist_path
-embeddings =  embedding_retrieval.JohnSnowLabsLangChainEmbedder(embeddings_model)
+embeddings = HuggingFaceEmbeddings(model_name=embeddings_model, model_kwargs={"device": "cuda" if torch.cuda.is_available() else "cpu"}, encode_kwargs={"batch_size": 128, "normalize_embeddings": True})
+# embed a dummy query up front, so CUDA and allocator setup happen here rather than in the first question
+embedding_dim = len(embeddings.embed_query("warmup"))
+if torch.cuda.is_available():
+  torch.cuda.synchronize()
 
-db = Chroma(collection_name="hls_docs", embedding_function=embeddings, persist_directory=db_persist_path)
+db = FAISS.load_local(db_persist_path, embeddings, distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT)
 
 #k here is a particularly important parameter; this is how many chunks of text we want to retrieve from the vectorstore
-retriever = db.as_retriever(search_kwargs={"k": 3})
+k = 3
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC Questions to a Q&A app are often repeated, or asked again with slightly different wording. We keep a small in-memory cache of recent searches so those don't need to search the vectorstore again:
+# MAGIC - For a question that was asked before (ignoring case and whitespace), the search is served straight from the cache, without even embedding the question
+# MAGIC - Otherwise the question is embedded, and if its embedding is nearly identical to that of a cached question (cosine similarity of at least `similarity_threshold`), that question's chunks are reused (as long as at least as many chunks were retrieved for it)
+# MAGIC - Only the search is cached: the LLM is still called to answer every question
+
+# COMMAND ----------
+
+from collections import OrderedDict
+import numpy as np
+
+cache_size = 1024
+similarity_threshold = 0.97
+# cached question embeddings live in one preallocated matrix, so comparing a new question against all of them is a single matrix-vector product
+cached_query_vecs = np.empty((cache_size, embedding_dim), dtype=np.float32)
+cached_ks = np.zeros(cache_size, dtype=np.int64)
+cached_results = []
+num_cached = 0
+# exact repeats, keyed by the lowercased, whitespace-collapsed question
+exact_cache = OrderedDict()
+
+def _similarity_search_near_duplicate(question, k):
+  global num_cached
+  # the embeddings model returns unit-length vectors, so the inner product is the cosine similarity
+  query_vec = np.asarray(embeddings.embed_query(question), dtype=np.float32)
+  if cached_results:
+    sims = cached_query_vecs[:len(cached_results)] @ query_vec
+    # only entries that retrieved at least k chunks can answer this search
+    sims[cached_ks[:len(cached_results)] < k] = -np.inf
+    best = int(sims.argmax())
+    if sims[best] >= similarity_threshold:
+      return cached_results[best][:k]
+
+  results = db.similarity_search_by_vector(query_vec.tolist(), k=k)
+  # once the cache is full, the oldest entry is overwritten
+  slot = num_cached % cache_size
+  cached_query_vecs[slot] = query_vec
+  cached_ks[slot] = k
+  if slot < len(cached_results):
+    cached_results[slot] = results
+  else:
+    cached_results.append(results)
+  num_cached += 1
+  return results
+
+def similarity_search_cached(question, k=k):
+  # the normalized question is only the cache key; the original question is what gets embedded and searched
+  key = (" ".join(question.lower().split()), k)
+  if key in exact_cache:
+    exact_cache.move_to_end(key)
+    return exact_cache[key]
+
+  results = _similarity_search_near_duplicate(question, k)
+  exact_cache[key] = results
+  if len(exact_cache) > cache_size:
+    exact_cache.popitem(last=False)
+  return results
 
 # COMMAND ----------
 
@@ -170,7 +236,7 @@ qa_chain = build_qa_chain()
 # COMMAND ----------
 
 def answer_question(question):
-  similar_docs = retriever.get_relevant_documents(question)
+  similar_docs = similarity_search_cached(question)
   result = qa_chain({"input_documents": similar_docs, "question": question})
   result_html = f"<p><blockquote style=\"font-size:24\">{question}</blockquote></p>"
   result_html += f"<p><blockquote style=\"font-size:18px\">{result['output_text']}</blockquote></p>" #depending on which prompt template you use, different response parsing might be needed - try the below if you get "IndexError: list index out of range"
@@ -1,5 +1,5 @@
 # Databricks notebook source
-# MAGIC %pip install -U transformers==4.29.2 sentence-transformers==2.2.2 langchain==0.0.190 chromadb==0.3.25
+# MAGIC %pip install -U transformers==4.29.2 sentence-transformers==2.2.2 langchain==0.0.335 faiss-cpu==1.7.4
 
 # COMMAND ----------
 
@@ -1,8 +1,15 @@
 # Databricks notebook source
-# MAGIC %pip install -U transformers==4.29.2 sentence-transformers==2.2.2 langchain==0.0.335 chromadb==0.3.25 pypdf==3.9.1 pycryptodome==3.18.0 accelerate==0.19.0 unstructured==0.7.1 unstructured[local-inference]==0.7.1 sacremoses==0.0.53 ninja==1.11.1 tiktoken johnsnowlabs==5.1.8rc2
+# MAGIC %pip install -U transformers==4.29.2 sentence-transformers==2.2.2 langchain==0.0.335 faiss-cpu==1.7.4 pymupdf==1.23.6 pycryptodome==3.18.0 accelerate==0.19.0 unstructured==0.7.1 unstructured[local-inference]==0.7.1 sacremoses==0.0.53 ninja==1.11.1 tiktoken
 # MAGIC dbutils.library.restartPython()
 
 # COMMAND ----------
 
 import nltk
-nltk.download('punkt')
+
+# download punkt only if it isn't already available; keeping it on /dbfs lets later runs on the driver reuse the download
+nltk_data_path = "/dbfs/tmp/nltk_data"
+nltk.data.path.insert(0, nltk_data_path)
+try:
+  nltk.data.find('tokenizers/punkt')
+except LookupError:
+  nltk.download('punkt', download_dir=nltk_data_path)